@@ -1,9 +1,6 @@
-import json, random
+import orjson, random
 from datetime import datetime, timedelta
 
-data = []
-now = datetime.utcnow()
-
 metrics = [
     "rag_ingested_docs_total",
     "rag_index_size",
@@ -12,17 +9,27 @@ metrics = [
     "rag_generation_time_seconds"
 ]
 
-for i in range(0, 120):  # 120 data points (last 2 hours if spaced 1 min apart)
-    ts = now - timedelta(minutes=(120 - i))
-    for metric in metrics:
-        data.append({
-            "@timestamp": ts.isoformat() + "Z",
-            "metric": metric,
-            "value": round(random.uniform(0.1, 100.0), 2),
-            "labels": {"job": "rag_system", "instance": "host.docker.internal:8000"}
-        })
+# Shared by every point instead of building a fresh dict per data point
+LABELS = {"job": "rag_system", "instance": "host.docker.internal:8000"}
+
+def iter_mock_points(points=120):
+    """Yield mock metric docs (last 2 hours if spaced 1 min apart)"""
+    now = datetime.utcnow()
+    for i in range(0, points):
+        ts = now - timedelta(minutes=(points - i))
+        for metric in metrics:
+            yield {
+                "@timestamp": ts.isoformat() + "Z",
+                "metric": metric,
+                "value": round(random.uniform(0.1, 100.0), 2),
+                "labels": LABELS
+            }
+
+if __name__ == "__main__":
+    data = list(iter_mock_points())
 
-with open("mock_metrics.json", "w", encoding="utf-8") as f:
-    json.dump(data, f, indent=2)
+    # NDJSON: one compact doc per line, already in bulk-friendly shape
+    with open("mock_metrics.ndjson", "wb") as f:
+        f.write(b"".join(orjson.dumps(d, option=orjson.OPT_APPEND_NEWLINE) for d in data))
 
-print(f"✅ Generated {len(data)} mock metric points.")
+    print(f"✅ Generated {len(data)} mock metric points.")
@@ -1,20 +1,31 @@
 import json
-import requests
+from elasticsearch import Elasticsearch  # pinned <9 in requirements.txt to match the ES 8.10 server
+from elasticsearch.helpers import parallel_bulk
+from generate_mock_data import iter_mock_points
 
-ES_URL = "http://localhost:9200/prometheus_bridge/_bulk"
-FILE = "mock_metrics.json"
+ES_HOST = "http://localhost:9200"
+INDEX = "prometheus_bridge"
 
-with open(FILE, "r", encoding="utf-8") as f:
-    data = json.load(f)
+# Stream freshly generated docs straight into bulk actions (no intermediate file);
+# chunk_size <= max_chunk_bytes / avg_doc_size keeps memory bounded
+actions = ({"_index": INDEX, "_source": doc} for doc in iter_mock_points())
 
-# Prepare NDJSON bulk body
-bulk_lines = []
-for doc in data:
-    bulk_lines.append(json.dumps({"index": {"_index": "prometheus_bridge"}}))
-    bulk_lines.append(json.dumps(doc))
-bulk_body = "\n".join(bulk_lines) + "\n"
+es = Elasticsearch(ES_HOST)
+indexed, failed = 0, 0
+for ok, info in parallel_bulk(
+    es,
+    actions,
+    chunk_size=5000,
+    max_chunk_bytes=50 * 1024 * 1024,
+    thread_count=8,
+    queue_size=4,
+    raise_on_error=False,
+):
+    if ok:
+        indexed += 1
+    else:
+        failed += 1
+        if failed <= 5:
+            print("⚠️ Failed:", json.dumps(info)[:300])
 
-r = requests.post(ES_URL, data=bulk_body, headers={"Content-Type": "application/x-ndjson"})
-
-print("Status:", r.status_code)
-print("Response:", r.text[:500])
+print(f"Indexed: {indexed}, Failed: {failed}")
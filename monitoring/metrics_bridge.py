@@ -6,59 +6,76 @@ Pulls metrics from /metrics endpoints and pushes to Elasticsearch every few seco
 
 import requests, time, re, json
 from datetime import datetime
+from elasticsearch import Elasticsearch  # pinned <9 in requirements.txt to match the ES 8.10 server
+from elasticsearch.helpers import bulk
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from prom_parser import parse_prometheus_metrics  # compile with mypyc for speed (see prom_parser.py)
 
 PROM_ENDPOINTS = [
     "http://localhost:8000/metrics",  # rag_ingest
     "http://localhost:8011/metrics",  # rag_query
 ]
 
-ELASTIC_URL = "http://localhost:9200/rag_metrics/_doc"
+ELASTIC_HOST = "http://localhost:9200"
+ELASTIC_INDEX = "rag_metrics"
 
-def parse_prometheus_metrics(text):
-    """Parse Prometheus metrics text into a dictionary."""
-    metrics = {}
-    for line in text.splitlines():
-        if line.startswith("#") or "{" in line:
-            continue
-        parts = line.strip().split()
-        if len(parts) == 2:
-            name, value = parts
-            try:
-                metrics[name] = float(value)
-            except ValueError:
-                pass
-    return metrics
+es = Elasticsearch(ELASTIC_HOST, request_timeout=5)
+
+# Scrape session: one quick connect retry, no read retries, so a dead endpoint can't stall a 10s tick
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=1, connect=1, read=0))
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
 
-def push_to_elasticsearch(service_name, metrics):
-    """Push metrics into Elasticsearch."""
-    payload = {
+def build_metrics_doc(service_name, samples):
+    """
+    Build one Elasticsearch document for a service's scraped samples.
+    Unlabeled samples go under "metrics" (metric names never contain dots); labeled ones go
+    under "series" as {name, labels, value} objects, since label values such as le="0.005"
+    would otherwise become dotted (nested) field names.
+    """
+    return {
         "@timestamp": datetime.utcnow().isoformat(),
         "service": service_name,
-        "metrics": metrics,
+        "metrics": {name: value for name, labels, value in samples if not labels},
+        "series": [
+            {"name": name, "labels": labels, "value": value}
+            for name, labels, value in samples if labels
+        ],
     }
+
+def push_to_elasticsearch(docs):
+    """Flush buffered metric documents into Elasticsearch in one bulk request."""
+    if not docs:
+        return
+    actions = ({"_index": ELASTIC_INDEX, "_source": doc} for doc in docs)
     try:
-        res = requests.post(ELASTIC_URL, json=payload, timeout=5)
-        if res.status_code in (200, 201):
-            print(f"✅ Pushed metrics for {service_name}")
-        else:
-            print(f"⚠️ ES push failed ({res.status_code}): {res.text[:120]}")
+        # A handful of docs per tick: a single synchronous bulk call, no thread pool
+        indexed, errors = bulk(es, actions, raise_on_error=False, raise_on_exception=False)
+        for info in errors:
+            print(f"⚠️ ES push failed: {json.dumps(info)[:120]}")
+        if indexed:
+            print(f"✅ Pushed {indexed}/{len(docs)} metric docs for {', '.join(doc['service'] for doc in docs)}")
     except Exception as e:
         print(f"⚠️ Failed to push to ES: {e}")
 
 def main():
     print("🔁 Prometheus → Elasticsearch bridge running...")
     while True:
+        docs = []
         for url in PROM_ENDPOINTS:
             service_name = url.split(":")[2].split("/")[0]
             try:
-                r = requests.get(url, timeout=5)
+                r = session.get(url, timeout=5)
                 if r.status_code == 200:
-                    metrics = parse_prometheus_metrics(r.text)
-                    push_to_elasticsearch(service_name, metrics)
+                    samples = parse_prometheus_metrics(r.text)
+                    docs.append(build_metrics_doc(service_name, samples))
                 else:
                     print(f"⚠️ Cannot fetch from {url}: {r.status_code}")
             except Exception as e:
                 print(f"⚠️ Error fetching {url}: {e}")
+        push_to_elasticsearch(docs)
         time.sleep(10)  # refresh every 10s
 
 if __name__ == "__main__":
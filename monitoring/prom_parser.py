@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Prometheus text-format parser used by metrics_bridge.
+- Fully type-annotated so it can be AOT-compiled with mypyc:
+      pip install mypy && mypyc prom_parser.py
+  The resulting extension module (.so/.pyd) is imported in place of this file;
+  without it the same code runs as plain Python.
+- Single pass per line with str.find (no regex); never assumes well-formed input.
+  Adversarial cases are covered by test_prom_parser.py (re-run it after a mypyc build).
+"""
+
+import math
+
+BLANKS = " \t"
+
+
+def _skip_blanks(line: str, i: int) -> int:
+    n: int = len(line)
+    while i < n and line[i] in BLANKS:
+        i += 1
+    return i
+
+
+def _parse_labels(line: str, start: int, labels: dict[str, str]) -> int:
+    """
+    Parse 'k="v",...}' starting just after '{' into labels.
+    Pairs must be separated by ',' (a trailing ',' before '}' is allowed).
+    Returns the index after the closing '}', or -1 if the label set is malformed.
+    """
+    n: int = len(line)
+    i: int = _skip_blanks(line, start)
+    if i < n and line[i] == "}":
+        return i + 1
+    while i < n:
+        eq: int = line.find("=", i)
+        if eq == -1:
+            return -1
+        name: str = line[i:eq].strip(BLANKS)
+        if not (name.isascii() and name.isidentifier()):
+            return -1
+        j: int = _skip_blanks(line, eq + 1)
+        if j >= n or line[j] != '"':
+            return -1
+        j += 1
+        end: int = line.find('"', j)
+        if end == -1:
+            return -1
+        if line.find("\\", j, end) == -1:
+            # Fast path: no escapes before the closing quote
+            labels[name] = line[j:end]
+            j = end + 1
+        else:
+            chars: list[str] = []
+            closed: bool = False
+            while j < n:
+                c: str = line[j]
+                if c == "\\" and j + 1 < n:
+                    nxt: str = line[j + 1]
+                    chars.append("\n" if nxt == "n" else nxt)
+                    j += 2
+                elif c == '"':
+                    closed = True
+                    j += 1
+                    break
+                else:
+                    chars.append(c)
+                    j += 1
+            if not closed:
+                return -1
+            labels[name] = "".join(chars)
+        # After each value: ',' (optionally followed by '}') or '}'
+        j = _skip_blanks(line, j)
+        if j >= n:
+            return -1
+        if line[j] == "}":
+            return j + 1
+        if line[j] != ",":
+            return -1
+        i = _skip_blanks(line, j + 1)
+        if i < n and line[i] == "}":
+            return i + 1
+    return -1
+
+
+def parse_prometheus_metrics(text: str) -> list[tuple[str, dict[str, str], float]]:
+    """
+    Parse Prometheus metrics text into (name, labels, value) samples.
+    Blanks may be spaces or tabs; trailing timestamps are ignored.
+    Malformed lines and non-finite values (NaN/±Inf, not valid JSON) are skipped.
+    """
+    samples: list[tuple[str, dict[str, str], float]] = []
+    for raw in text.splitlines():
+        line: str = raw.strip(BLANKS)
+        if not line or line[0] == "#":
+            continue
+        n: int = len(line)
+        name_end: int = 0
+        while name_end < n and line[name_end] != "{" and line[name_end] not in BLANKS:
+            name_end += 1
+        if name_end == 0:
+            continue
+        labels: dict[str, str] = {}
+        pos: int = name_end
+        if pos < n and line[pos] == "{":
+            pos = _parse_labels(line, pos + 1, labels)
+            if pos == -1:
+                continue
+        if pos >= n or line[pos] not in BLANKS:
+            continue
+        tokens: list[str] = line[pos:].split()
+        # value [timestamp] only; '_' would let Python-only literals like 1_000 through
+        if len(tokens) > 2 or "_" in tokens[0]:
+            continue
+        try:
+            value: float = float(tokens[0])
+        except ValueError:
+            continue
+        if not math.isfinite(value):
+            continue
+        samples.append((line[:name_end], labels, value))
+    return samples
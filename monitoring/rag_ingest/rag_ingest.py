@@ -2,15 +2,17 @@
 """
 robust rag_ingest.py
 - Scans ./docs for .txt files
-- Builds FAISS index + metadata.json
+- Builds FAISS index + metadata.npz (struct-of-arrays chunk metadata)
 - Exposes Prometheus metrics at :8000/metrics
 - Works from any directory (absolute paths)
 """
 
 import os
-import json
 import time
 import re
+import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
@@ -27,10 +29,22 @@ except ImportError:
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DOCS_DIR = os.path.join(BASE_DIR, "docs")
 INDEX_FILE = os.path.join(BASE_DIR, "vector_index.faiss")
-META_FILE = os.path.join(BASE_DIR, "metadata.json")
+META_FILE = os.path.join(BASE_DIR, "metadata.npz")
+EMBED_CACHE_FILE = os.path.join(BASE_DIR, "embedding_cache.sqlite")
+SQLITE_IN_BATCH = 500  # keys per "IN (...)" lookup, well under sqlite's bound-parameter limit
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 PROM_PORT = 8000
 CHUNK_SIZE = 400
+IVF_MIN_VECTORS = 10000  # below this, exact flat search is fast enough
+IVF_NPROBE = 8
+# int8 scalar quantization: 4x smaller vectors, typically <1% recall loss on MiniLM.
+# Set FAISS_INDEX_PRECISION=fp32 for exact (eval) runs.
+INDEX_PRECISION = os.getenv("FAISS_INDEX_PRECISION", "int8").lower()
+# Encode with one worker process per usable core once there are enough new chunks to amortize
+# worker startup. sched_getaffinity respects container/affinity limits; cpu_count() does not.
+_USABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+ENCODE_PROCESSES = int(os.getenv("ENCODE_PROCESSES", str(_USABLE_CPUS)))
+MULTI_PROCESS_MIN_CHUNKS = 5000
 
 
 # Prometheus Metrics
@@ -46,6 +60,74 @@ rag_last_index_unix = Gauge(
 )
 
 
+# Embedding Cache
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of embeddings (sqlite).
+    Keys are hash(model_name + text), so swapping models never serves stale vectors.
+    Only ingest uses this file; rag_query keeps its query vectors in a bounded in-memory LRU.
+    """
+
+    def __init__(self, path=EMBED_CACHE_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)"
+        )
+
+    @staticmethod
+    def key(model_name, text):
+        return hashlib.blake2b(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_or_compute_many(self, texts, model_name, encode_fn):
+        """
+        Return an (N, d) float32 matrix, encoding only texts missing from the cache.
+        Rows are written in place into one preallocated matrix (no list-of-arrays copy).
+        """
+        rows_by_key = {}
+        for row, t in enumerate(texts):
+            rows_by_key.setdefault(self.key(model_name, t), []).append(row)
+
+        emb_matrix = None
+        hits = set()
+        unique_keys = list(rows_by_key)
+        for i in range(0, len(unique_keys), SQLITE_IN_BATCH):
+            batch = unique_keys[i:i + SQLITE_IN_BATCH]
+            rows = self.conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            for k, vec in rows:
+                v = np.frombuffer(vec, dtype=np.float32)
+                if emb_matrix is None:
+                    emb_matrix = np.empty((len(texts), v.shape[0]), dtype=np.float32)
+                emb_matrix[rows_by_key[k]] = v
+                hits.add(k)
+
+        missing = [k for k in unique_keys if k not in hits]
+        if missing:
+            new_vecs = np.asarray(encode_fn([texts[rows_by_key[k][0]] for k in missing]), dtype=np.float32)
+            if emb_matrix is None and len(missing) == len(texts):
+                # Cold cache, no duplicates: the encoder output is already the contiguous matrix
+                emb_matrix = new_vecs
+            else:
+                if emb_matrix is None:
+                    emb_matrix = np.empty((len(texts), new_vecs.shape[1]), dtype=np.float32)
+                for k, v in zip(missing, new_vecs):
+                    emb_matrix[rows_by_key[k]] = v
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                    ((k, v.tobytes()) for k, v in zip(missing, new_vecs)),
+                )
+
+        print(f"🗃️ Embedding cache: encoded {len(missing)} of {len(texts)} chunks")
+        return emb_matrix
+
+    def close(self):
+        self.conn.close()
+
+
 # Helper Functions
 
 def ensure_docs_dir():
@@ -57,20 +139,92 @@ def ensure_docs_dir():
         return False
     return True
 
+def _read_file(file_name):
+    with open(os.path.join(DOCS_DIR, file_name), "r", encoding="utf-8") as f:
+        return f.read()
+
 def read_text_files():
-    """Read all .txt files from docs folder"""
-    texts = []
-    for file_name in sorted(os.listdir(DOCS_DIR)):
-        if file_name.endswith(".txt"):
-            with open(os.path.join(DOCS_DIR, file_name), "r", encoding="utf-8") as f:
-                texts.append((file_name, f.read()))
-    return texts
+    """Read all .txt files from docs folder (concurrently, to overlap open/read latency)"""
+    names = sorted(n for n in os.listdir(DOCS_DIR) if n.endswith(".txt"))
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        return list(zip(names, ex.map(_read_file, names)))
+
+def encode_chunks(model, chunks):
+    """Batch-encode chunks into an L2-normalized float32 matrix (multi-process for large inputs)"""
+    if ENCODE_PROCESSES > 1 and len(chunks) >= MULTI_PROCESS_MIN_CHUNKS:
+        # One torch intra-op thread per worker (read at import in the spawned children);
+        # otherwise N workers x N default threads oversubscribe the CPU
+        saved = {k: os.environ.get(k) for k in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+        os.environ.update({k: "1" for k in saved})
+        try:
+            pool = model.start_multi_process_pool(target_devices=["cpu"] * ENCODE_PROCESSES)
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        try:
+            emb_matrix = model.encode_multi_process(chunks, pool, batch_size=64)
+        finally:
+            model.stop_multi_process_pool(pool)
+        emb_matrix = np.ascontiguousarray(emb_matrix, dtype=np.float32)
+        faiss.normalize_L2(emb_matrix)  # single in-place pass over the contiguous output
+        return emb_matrix
+    return model.encode(
+        chunks,
+        batch_size=64,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True,
+    )
+
+def save_metadata(docs, chunks, chunk_file_ids):
+    """
+    Save chunk metadata as struct-of-arrays (no per-chunk dicts, no pickle):
+    one utf-8 blob of preview texts + int64 offsets, and int32 file ids into a file-name table.
+    rag_query only reads text_blob/text_offsets; file_names/file_ids are ingest-side provenance
+    (chunk -> source file) for inspection and re-ingest tooling.
+    """
+    previews = [(c[:300] + ("..." if len(c) > 300 else "")).encode("utf-8") for c in chunks]
+    offsets = np.zeros(len(previews) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in previews], out=offsets[1:])
+    np.savez(
+        META_FILE,
+        text_blob=np.frombuffer(b"".join(previews), dtype=np.uint8),
+        text_offsets=offsets,
+        file_names=np.array([name for name, _ in docs], dtype=str),
+        file_ids=np.array(chunk_file_ids, dtype=np.int32),
+    )
+
+def build_faiss_index(emb_matrix):
+    """Flat inner-product index for small corpora, IVF (sqrt(N) lists) once the corpus grows"""
+    d = emb_matrix.shape[1]
+    quantize = INDEX_PRECISION != "fp32"
+    if len(emb_matrix) <= IVF_MIN_VECTORS:
+        if quantize:
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexFlatIP(d)
+    else:
+        nlist = max(1, int(np.sqrt(len(emb_matrix))))
+        quantizer = faiss.IndexFlatIP(d)
+        if quantize:
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, d, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = IVF_NPROBE
+    if not index.is_trained:
+        index.train(emb_matrix)
+    index.add(emb_matrix)
+    return index
 
 def chunk_text(text, size=CHUNK_SIZE):
-    """Split text into fixed-length word chunks"""
+    """Split text into fixed-length word chunks (returned as a list, ready for batch encoding)"""
     words = text.split()
-    for i in range(0, len(words), size):
-        yield " ".join(words[i:i + size])
+    return [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
 
 
 # Core Ingestion Logic
@@ -88,33 +242,39 @@ def build_index_once():
         return
 
     print(f"🔍 Building FAISS index from {len(docs)} files...")
-    all_embeddings = []
-    metadata = []
-
-    for file_name, content in tqdm(docs, desc="Processing"):
-        for chunk in chunk_text(content):
-            emb = model.encode(chunk, convert_to_numpy=True)
-            all_embeddings.append(emb)
-            metadata.append({
-                "file": file_name,
-                "text": chunk[:300] + ("..." if len(chunk) > 300 else "")
-            })
-            rag_ingested_chunks_total.inc()
-
-    emb_matrix = np.array(all_embeddings, dtype=np.float32)
-    faiss.normalize_L2(emb_matrix)
-
-    index = faiss.IndexFlatIP(emb_matrix.shape[1])
-    index.add(emb_matrix)
+    chunks = []
+    chunk_file_ids = []
+
+    for file_id, (file_name, content) in enumerate(tqdm(docs, desc="Chunking")):
+        doc_chunks = chunk_text(content)
+        chunks.extend(doc_chunks)
+        chunk_file_ids.extend([file_id] * len(doc_chunks))
+
+    if not chunks:
+        print("⚠️ Documents contained no text to index. Exiting.")
+        return
+
+    # Encode uncached chunks in batched forward passes (normalized for cosine/IP search)
+    cache = EmbeddingCache()
+    try:
+        emb_matrix = cache.get_or_compute_many(
+            chunks,
+            MODEL_NAME,
+            lambda batch: encode_chunks(model, batch),
+        )
+    finally:
+        cache.close()
+    rag_ingested_chunks_total.inc(len(chunks))
+
+    index = build_faiss_index(emb_matrix)
     faiss.write_index(index, INDEX_FILE)
 
-    with open(META_FILE, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
+    save_metadata(docs, chunks, chunk_file_ids)
 
-    rag_index_size.set(len(all_embeddings))
+    rag_index_size.set(len(chunks))
     rag_last_index_unix.set(time.time())
 
-    print(f"✅ Indexed {len(all_embeddings)} chunks across {len(docs)} documents.")
+    print(f"✅ Indexed {len(chunks)} chunks across {len(docs)} documents.")
     print(f"📦 Saved index: {INDEX_FILE}")
     print(f"🧾 Saved metadata: {META_FILE}")
 
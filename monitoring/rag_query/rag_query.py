@@ -1,37 +1,53 @@
 #!/usr/bin/env python3
 """
 Autonomous RAG Query Service (fixed)
-- Loads FAISS index and metadata
+- Loads FAISS index and struct-of-arrays chunk metadata
 - Retrieves top-K document chunks per query
-- Uses local Ollama model for contextual answers
+- Uses local Ollama model for contextual answers (async, pooled aiohttp, cached per prompt)
 - Exposes Prometheus metrics at /metrics (same port as API)
-- Logs query performance + results to Elasticsearch (with small retries)
+- Logs query performance + results to Elasticsearch in the background (with small retries)
 """
 
 import os
 import json
 import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
 import faiss
 import numpy as np
+import orjson
 import requests
-from fastapi import FastAPI, Query
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from fastapi import FastAPI, Query, Request, BackgroundTasks
 from fastapi.responses import JSONResponse, Response
 from sentence_transformers import SentenceTransformer
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import uvicorn
 from datetime import datetime
-from typing import Any
+from typing import Any, Optional
 
 
 # Paths & Constants
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 INDEX_FILE = os.path.join(BASE_DIR, "vector_index.faiss")
-META_FILE = os.path.join(BASE_DIR, "metadata.json")
+META_FILE = os.path.join(BASE_DIR, "metadata.npz")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "10000"))  # in-memory query-vector LRU size
+OLLAMA_CACHE_FILE = os.path.join(BASE_DIR, "ollama_cache.sqlite")
+OLLAMA_CACHE_TTL = float(os.getenv("OLLAMA_CACHE_TTL_SECONDS", "3600"))
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 OLLAMA_MODEL = "llama3"
+OLLAMA_URL = "http://localhost:11434"
 APP_PORT = 8011
 TOP_K = 3
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))  # coalesce queries arriving within this window
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "32"))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "8"))  # IVF lists probed per query (ignored for flat indexes)
 
 # Elasticsearch: index and document endpoint
 ELASTIC_INDEX = "rag_queries"
@@ -40,12 +56,27 @@ ELASTIC_INDEX_URL = f"http://host.docker.internal:9200/{ELASTIC_INDEX}"
 ELASTIC_DOC_URL = f"{ELASTIC_INDEX_URL}/_doc"
 
 
+# Shared HTTP session for Elasticsearch (keep-alive pool; the log POST is only retried on connect errors)
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3))
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
 # Prometheus Metrics
 
 rag_queries_total = Counter("rag_queries_total", "Total number of RAG queries processed", ["status"])
 rag_retrieval_time = Histogram("rag_retrieval_time_seconds", "Time taken for document retrieval")
 rag_generation_time = Histogram("rag_generation_time_seconds", "Time taken for LLM generation")
-faiss_index_size = Counter("rag_faiss_index_vectors", "Number of vectors in the FAISS index")
+rag_http_request_time = Histogram(
+    "rag_http_request_duration_seconds", "HTTP request latency per endpoint", ["method", "path", "status"]
+)
+rag_ollama_http_time = Histogram("rag_ollama_http_seconds", "Ollama HTTP round-trip time (aiohttp trace)")
+rag_ollama_cache_total = Counter(
+    "rag_ollama_cache_total", "Ollama response cache lookups", ["result"]  # hit / miss / coalesced
+)
+faiss_index_size = Gauge("rag_faiss_index_vectors", "Number of vectors in the FAISS index")
 
 
 # FastAPI App
@@ -57,6 +88,24 @@ app = FastAPI(
 )
 
 
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Record per-endpoint latency histograms for every request."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        rag_http_request_time.labels(
+            method=request.method,
+            path=route.path if route is not None else "unmatched",
+            status=str(status),
+        ).observe(time.perf_counter() - start)
+
+
 # Ensure Elasticsearch index exists (mapping)
 
 DEFAULT_MAPPING = {
@@ -77,7 +126,7 @@ DEFAULT_MAPPING = {
 def ensure_elastic_index(timeout: float = 3.0) -> bool:
     
     try:
-        r = requests.get(ELASTIC_INDEX_URL, timeout=timeout)
+        r = session.get(ELASTIC_INDEX_URL, timeout=timeout)
         if r.status_code == 200:
             print(f"✅ Elasticsearch index '{ELASTIC_INDEX}' exists.")
             return True
@@ -86,7 +135,7 @@ def ensure_elastic_index(timeout: float = 3.0) -> bool:
         pass
 
     try:
-        r = requests.put(ELASTIC_INDEX_URL, json=DEFAULT_MAPPING, timeout=timeout)
+        r = session.put(ELASTIC_INDEX_URL, json=DEFAULT_MAPPING, timeout=timeout)
         if r.status_code in (200, 201):
             print(f"✅ Created Elasticsearch index '{ELASTIC_INDEX}'.")
             return True
@@ -99,6 +148,56 @@ def ensure_elastic_index(timeout: float = 3.0) -> bool:
 
 
 
+# Query Embedding Cache
+
+class EmbeddingCache:
+    """
+    Bounded in-memory LRU of query embeddings, keyed by hash(model_name + text).
+    Client-supplied queries are never persisted, so they cannot grow a file or contend
+    with rag_ingest for its sqlite write lock; the oldest entries are evicted past max_entries.
+    """
+
+    def __init__(self, max_entries: int = EMBED_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vecs: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.blake2b(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_or_compute_many(self, texts: list, model_name: str, encode_fn) -> np.ndarray:
+        """Return an (N, d) float32 matrix, encoding only texts missing from the cache (in one call)."""
+        keys = [self.key(model_name, t) for t in texts]
+        found = {}
+        with self._lock:
+            for k in keys:
+                vec = self._vecs.get(k)
+                if vec is not None:
+                    self._vecs.move_to_end(k)
+                    found[k] = vec
+
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                missing.setdefault(k, t)
+        if missing:
+            # encode() already L2-normalizes; asarray is a no-op view on its float32 output
+            new_vecs = np.asarray(encode_fn(list(missing.values())), dtype=np.float32)
+            with self._lock:
+                for k, v in zip(missing, new_vecs):
+                    self._vecs[k] = v
+                    self._vecs.move_to_end(k)
+                while len(self._vecs) > self.max_entries:
+                    self._vecs.popitem(last=False)
+            if len(missing) == len(keys):
+                # Every query was new and unique: search the encoder output directly, no extra pass
+                return new_vecs
+            found.update(zip(missing, new_vecs))
+        return np.stack([found[k] for k in keys])
+
+
+
 # Initialization
 
 print("🧠 Loading model and FAISS index...")
@@ -107,78 +206,220 @@ _elastic_ready = ensure_elastic_index()
 
 
 model = SentenceTransformer(MODEL_NAME)
+embedding_cache = EmbeddingCache()
 if not os.path.exists(INDEX_FILE) or not os.path.exists(META_FILE):
-    raise FileNotFoundError("❌ Missing FAISS index or metadata.json. Run rag_ingest.py first.")
+    raise FileNotFoundError("❌ Missing FAISS index or metadata.npz. Run rag_ingest.py first.")
+
+# IO_FLAG_MMAP_IFC (newer faiss) maps flat/scalar-quantized codes too, so pages are demand-loaded
+# and shared between replicas. Plain IO_FLAG_MMAP only maps IVF inverted lists: flat and SQ
+# indexes (the default below IVF_MIN_VECTORS) are still copied into RAM on older faiss.
+_mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+if _mmap_flag is None:
+    _mmap_flag = faiss.IO_FLAG_MMAP
+    print("ℹ️ faiss lacks IO_FLAG_MMAP_IFC; only IVF inverted lists will be memory-mapped.")
+try:
+    index = faiss.read_index(INDEX_FILE, _mmap_flag | faiss.IO_FLAG_READ_ONLY)
+except RuntimeError as e:
+    print(f"⚠️ mmap load not supported for this index ({e}); reading into memory.")
+    index = faiss.read_index(INDEX_FILE)
+if isinstance(index, faiss.IndexIVF):
+    index.nprobe = FAISS_NPROBE
+with np.load(META_FILE) as meta:
+    # One bytes blob + offsets: chunk i is text_blob[text_offsets[i]:text_offsets[i + 1]]
+    # (file_names/file_ids are ingest-side provenance and are not loaded here)
+    text_blob = meta["text_blob"].tobytes()
+    text_offsets = meta["text_offsets"]
+num_chunks = len(text_offsets) - 1
+print(f"✅ Loaded index with {index.ntotal} vectors and {num_chunks} metadata entries.")
 
-index = faiss.read_index(INDEX_FILE)
-with open(META_FILE, "r", encoding="utf-8") as f:
-    metadata = json.load(f)
-print(f"✅ Loaded index with {index.ntotal} vectors and {len(metadata)} metadata entries.")
 
-try:
-    faiss_index_size.inc(int(index.ntotal))
-except Exception:
-    faiss_index_size.inc()
+def chunk_text_at(i: int) -> str:
+    return text_blob[text_offsets[i]:text_offsets[i + 1]].decode("utf-8")
+
+faiss_index_size.set(int(index.ntotal))
+
+
+# Ollama Interaction Helper (async, shared keep-alive pool)
+
+ollama_session: Optional[aiohttp.ClientSession] = None
 
 
-# Ollama Interaction Helper
+async def _on_request_start(session, trace_config_ctx, params):
+    trace_config_ctx.start = asyncio.get_running_loop().time()
 
-def run_ollama(prompt: str) -> str:
+
+async def _on_request_end(session, trace_config_ctx, params):
+    rag_ollama_http_time.observe(asyncio.get_running_loop().time() - trace_config_ctx.start)
+
+
+@app.on_event("startup")
+async def open_ollama_session():
+    global ollama_session
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    ollama_session = aiohttp.ClientSession(
+        base_url=OLLAMA_URL,
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+        # No cap on the whole stream (slow CPU generations are fine); 90s max between bytes
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=90),
+        trace_configs=[trace_config],
+    )
+
+
+@app.on_event("shutdown")
+async def close_ollama_session():
+    if ollama_session is not None:
+        await ollama_session.close()
+
+
+def _consume_ollama_line(line: bytes, parts: list) -> bool:
+    """Parse one NDJSON line from Ollama, appending its text; returns True once generation is done."""
+    if not line.strip():
+        return False
+    try:
+        data = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return False
+    if not isinstance(data, dict):
+        return False
+    piece = data.get("response", "")
+    if piece:
+        parts.append(piece)
+    return bool(data.get("done"))
+
+
+async def _generate(prompt: str) -> tuple:
     """
-    Query the local Ollama server through its HTTP API (streaming).
-    Returns full response string or an error string.
+    Query the local Ollama server through its HTTP API (streaming NDJSON).
+    Returns (text, ok): the full response with ok=True, or an error string with ok=False.
     """
     try:
-        resp = requests.post(
-            "http://localhost:11434/api/generate",
+        async with ollama_session.post(
+            "/api/generate",
             json={
                 "model": OLLAMA_MODEL,
                 "prompt": prompt,
                 "options": {"num_predict": 400, "temperature": 0.8, "top_p": 0.9}
             },
-            timeout=90,
-            stream=True
-        )
-        resp.raise_for_status()
-
-        parts = []
-        for line in resp.iter_lines(decode_unicode=True):
-            if not line:
-                continue
-            
-            try:
-                data = json.loads(line)
-            except Exception:
-                continue
-            if isinstance(data, dict):
-                chunk = data.get("response", "")
-                if chunk:
-                    parts.append(chunk)
-                if data.get("done"):
+        ) as resp:
+            resp.raise_for_status()
+
+            parts = []
+            buf = b""
+            done = False
+            # Read large raw chunks and split NDJSON lines ourselves; orjson parses bytes directly
+            async for chunk in resp.content.iter_chunked(65536):
+                buf += chunk
+                while not done and (nl := buf.find(b"\n")) != -1:
+                    line, buf = buf[:nl], buf[nl + 1:]
+                    done = _consume_ollama_line(line, parts)
+                if done:
                     break
+            if not done and buf:
+                _consume_ollama_line(buf, parts)
 
         full = "".join(parts).strip()
-        return full if full else "[No response]"
+        return (full, True) if full else ("[No response]", False)
 
-    except requests.exceptions.RequestException as e:
-        return f"[Ollama HTTP call failed: {e}]"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return f"[Ollama HTTP call failed: {e}]", False
     except Exception as e:
-        return f"[Ollama parse failed: {e}]"
+        return f"[Ollama parse failed: {e}]", False
+
+
+
+# Ollama Response Cache (sqlite + TTL, single-flight for identical prompts)
+
+class ResponseCache:
+    """
+    Persistent prompt-hash -> (response, timestamp) store; entries expire after ttl seconds.
+    Blocking sqlite calls: invoke get/set via asyncio.to_thread, never on the event loop.
+    """
+
+    def __init__(self, path: str = OLLAMA_CACHE_FILE, ttl: float = OLLAMA_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, ts REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_ts ON responses (ts)")
+
+    @staticmethod
+    def key(model_name: str, prompt: str) -> str:
+        return hashlib.blake2b(f"{model_name}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND ts >= ?", (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key: str, response: str) -> None:
+        """Store a response and sweep expired rows in the same transaction (indexed on ts)."""
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE ts < ?", (now - self.ttl,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+                (key, response, now),
+            )
+
+
+ollama_cache = ResponseCache()
+_inflight: dict = {}
+
+
+async def _generate_and_cache(key: str, prompt: str) -> str:
+    """Run one upstream generation, storing successful answers; shared by all coalesced callers."""
+    try:
+        answer, ok = await _generate(prompt)
+        if ok:
+            try:
+                await asyncio.to_thread(ollama_cache.set, key, answer)
+            except sqlite3.Error as e:
+                print(f"⚠️ Could not cache Ollama response: {e}")
+        return answer
+    finally:
+        _inflight.pop(key, None)
+
+
+async def run_ollama(prompt: str) -> str:
+    """
+    Cached Ollama generation: returns a stored answer on hit, and lets concurrent
+    identical prompts share a single upstream call.
+    """
+    key = ollama_cache.key(OLLAMA_MODEL, prompt)
+    # In-flight first: a generation finishing during the cache read below would otherwise
+    # pop its key and make this caller start a duplicate upstream call
+    task = _inflight.get(key)
+    if task is None:
+        cached = await asyncio.to_thread(ollama_cache.get, key)
+        if cached is not None:
+            rag_ollama_cache_total.labels(result="hit").inc()
+            return cached
+        task = _inflight.get(key)  # another caller may have started it while we read
+    if task is not None:
+        rag_ollama_cache_total.labels(result="coalesced").inc()
+    else:
+        rag_ollama_cache_total.labels(result="miss").inc()
+        # Owned by no single request: a disconnecting caller cancels only its own wait (shield),
+        # never the generation the other callers are waiting on
+        task = asyncio.create_task(_generate_and_cache(key, prompt))
+        _inflight[key] = task
+    return await asyncio.shield(task)
 
 
 
 # Elasticsearch Logging Helper (with retries)
 
-def _post_json_with_retries(url: str, payload: Any, attempts: int = 3, backoff: float = 0.5) -> requests.Response:
-    last_exc = None
-    for i in range(attempts):
-        try:
-            res = requests.post(url, headers={"Content-Type": "application/json"}, data=json.dumps(payload), timeout=5)
-            return res
-        except Exception as e:
-            last_exc = e
-            time.sleep(backoff * (i + 1))
-    raise last_exc
+def _post_json_with_retries(url: str, payload: Any) -> requests.Response:
+    # The session's adapter retries connect failures only; a POST is never re-sent after a
+    # read error, so a slow ES ACK cannot produce duplicate log documents
+    return session.post(url, json=payload, timeout=5)
 
 
 def log_to_elasticsearch(q: str, answer: str, retrieval_time: float, gen_time: float, status: str = "success") -> None:
@@ -199,7 +440,7 @@ def log_to_elasticsearch(q: str, answer: str, retrieval_time: float, gen_time: f
     print("🧾 [DEBUG] Payload preview:", json.dumps(log_entry, indent=2)[:500])
 
     try:
-        res = _post_json_with_retries(ELASTIC_DOC_URL, log_entry, attempts=3, backoff=0.5)
+        res = _post_json_with_retries(ELASTIC_DOC_URL, log_entry)
         print("🧾 [DEBUG] Elasticsearch response:", res.status_code)
         if res.status_code in (200, 201):
             print("✅ Successfully logged query to Elasticsearch.")
@@ -212,24 +453,100 @@ def log_to_elasticsearch(q: str, answer: str, retrieval_time: float, gen_time: f
 
 # Core Retrieval + Generation Endpoint
 
+def search_batch(queries: list):
+    """Embed a batch of queries in one forward pass and search FAISS once (blocking)."""
+    emb = embedding_cache.get_or_compute_many(
+        queries, MODEL_NAME, lambda batch: model.encode(batch, convert_to_numpy=True, normalize_embeddings=True)
+    )
+    return index.search(emb, TOP_K)
+
+
+class QueryBatcher:
+    """
+    Micro-batches concurrent queries: waits up to EMBED_BATCH_WINDOW_MS (or EMBED_BATCH_MAX items),
+    then runs one batched encode + search off the event loop and resolves each caller's future.
+    """
+
+    def __init__(self, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_BATCH_MAX):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def search(self, q: str):
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((q, fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                # FAISS and torch release the GIL, so the next wave keeps queueing meanwhile
+                scores, idxs = await asyncio.to_thread(search_batch, [q for q, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+
+            for row, (_, fut) in enumerate(batch):
+                if not fut.done():
+                    fut.set_result((scores[row:row + 1], idxs[row:row + 1]))
+
+
+query_batcher = QueryBatcher()
+
+
+@app.on_event("startup")
+async def start_query_batcher():
+    query_batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_query_batcher():
+    await query_batcher.stop()
+
+
 @app.get("/query")
-def query_docs(q: str = Query(..., description="User question")):
+async def query_docs(background: BackgroundTasks, q: str = Query(..., description="User question")):
     print(f"\n🔎 Received query: {q}")
     start_retrieval = time.time()
 
     try:
-        
-        emb = model.encode(q, convert_to_numpy=True).astype("float32")
-        faiss.normalize_L2(emb.reshape(1, -1))
-        scores, idxs = index.search(emb.reshape(1, -1), TOP_K)
+
+        scores, idxs = await query_batcher.search(q)
         retrieval_time = time.time() - start_retrieval
         rag_retrieval_time.observe(retrieval_time)
 
-        contexts = [metadata[i]["text"] for i in idxs[0] if i < len(metadata)]
+        contexts = [chunk_text_at(i) for i in idxs[0] if 0 <= i < num_chunks]
         context_combined = "\n\n".join(contexts)
         print(f"📚 Retrieved {len(contexts)} chunks in {retrieval_time:.3f}s")
 
-        
+
         start_gen = time.time()
         prompt = (
             "You are a helpful assistant.\n"
@@ -237,20 +554,17 @@ def query_docs(q: str = Query(..., description="User question")):
             f"Question: {q}\n\n"
             "Answer concisely and factually using only the context above."
         )
-        answer = run_ollama(prompt)
+        answer = await run_ollama(prompt)
         gen_time = time.time() - start_gen
         rag_generation_time.observe(gen_time)
         rag_queries_total.labels(status="success").inc()
 
         print(f"💬 Response generated in {gen_time:.3f}s")
 
-        
-        try:
-            log_to_elasticsearch(q, answer, retrieval_time, gen_time, status="success")
-        except Exception as e:
-            print(f"⚠️ Logging attempt raised (shouldn't stop response): {e}")
+        # Logged after the response is sent, off the critical path
+        background.add_task(log_to_elasticsearch, q, answer, retrieval_time, gen_time, status="success")
+
 
-        
         return JSONResponse({
             "query": q,
             "response": answer,
@@ -261,10 +575,7 @@ def query_docs(q: str = Query(..., description="User question")):
 
     except Exception as e:
         rag_queries_total.labels(status="error").inc()
-        try:
-            log_to_elasticsearch(q, str(e), 0.0, 0.0, status="error")
-        except Exception:
-            pass
+        background.add_task(log_to_elasticsearch, q, str(e), 0.0, 0.0, status="error")
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
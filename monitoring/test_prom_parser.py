@@ -0,0 +1,91 @@
+"""
+Adversarial checks for prom_parser.parse_prometheus_metrics.
+Run with `python test_prom_parser.py` (or pytest). Re-run after compiling with mypyc.
+"""
+
+from prom_parser import parse_prometheus_metrics
+
+
+def parse_one(line):
+    samples = parse_prometheus_metrics(line)
+    return samples[0] if samples else None
+
+
+def test_labels_with_brace_and_spaces():
+    assert parse_one('q{path="/a} b",code="200"} 3') == ("q", {"path": "/a} b", "code": "200"}, 3.0)
+
+
+def test_escaped_label_values():
+    assert parse_one('q{msg="say \\"hi\\"\\\\n",x="a\\nb"} 1') == ("q", {"msg": 'say "hi"\\n', "x": "a\nb"}, 1.0)
+
+
+def test_label_separators():
+    assert parse_one('m{a="x", b="y",} 3') == ("m", {"a": "x", "b": "y"}, 3.0)
+    assert parse_one("m{} 3") == ("m", {}, 3.0)
+
+
+def test_dotted_label_values_stay_values():
+    assert parse_one('h_bucket{le="0.005"} 4') == ("h_bucket", {"le": "0.005"}, 4.0)
+
+
+def test_missing_value():
+    assert parse_one("no_value") is None
+    assert parse_one("no_value   ") is None
+    assert parse_one('labeled{a="b"}') is None
+
+
+def test_trailing_timestamp_ignored():
+    assert parse_one("m 2.5 1700000000000") == ("m", {}, 2.5)
+    assert parse_one('m{a="b"} 2.5 1700000000000') == ("m", {"a": "b"}, 2.5)
+
+
+def test_tabs_and_leading_whitespace():
+    assert parse_one("tabbed_metric\t7") == ("tabbed_metric", {}, 7.0)
+    assert parse_one("  indented_metric 5") == ("indented_metric", {}, 5.0)
+    assert parse_one('\tm{a="b"}\t\t8\t') == ("m", {"a": "b"}, 8.0)
+
+
+def test_non_finite_values_skipped():
+    for v in ("NaN", "+Inf", "-Inf"):
+        assert parse_one(f"m {v}") is None
+
+
+def test_empty_name():
+    assert parse_one('{a="b"} 1') is None
+    assert parse_one(" 1") is None
+
+
+def test_malformed_lines_skipped():
+    bad = [
+        'm{a="b" 1',      # unterminated label set
+        'm{a="b} 1',      # unterminated quote
+        "m{a=b} 1",       # unquoted value
+        'm{="b"} 1',      # empty label name
+        'm{a="b"}1',      # no blank before value
+        "m abc",          # non-numeric value
+        "# HELP m help",
+        "# TYPE m counter",
+        "",
+        "\x00\x00 {{{ }}} 1",
+        "m 1_000",        # Python-only numeric literal
+        "m infinity",     # Python-only spelling (and non-finite)
+        'm{a="x" b="y"} 3',   # label pairs without a comma
+        'm{,a="x"} 3',    # leading comma
+        'm{a="x",,b="y"} 3',  # empty pair
+        'm{a b="x"} 3',   # invalid label name
+        "m 1 2 3",        # extra tokens after the timestamp
+    ]
+    for line in bad:
+        assert parse_one(line) is None, line
+
+
+def test_multiline_payload():
+    text = "# TYPE up gauge\nup 1\r\nbad line\n\nh_count{a=\"x\"} 2\n"
+    assert parse_prometheus_metrics(text) == [("up", {}, 1.0), ("h_count", {"a": "x"}, 2.0)]
+
+
+if __name__ == "__main__":
+    for name, fn in sorted(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✅ {name}")
@@ -1,6 +1,8 @@
 import time
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 
 # === CONFIG ===
@@ -10,10 +12,16 @@ INDEX = "prometheus_bridge"
 
 HEADERS = {"Content-Type": "application/json"}
 
+# Prometheus API + ES _bulk session; Retry's default allowed_methods never re-sends the bulk POST after a read error
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3))
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
 def fetch_metric_names():
     """Optional utility to list all metrics available in Prometheus"""
     try:
-        r = requests.get(f"{PROM}/api/v1/label/__name__/values", timeout=10)
+        r = session.get(f"{PROM}/api/v1/label/__name__/values", timeout=10)
         r.raise_for_status()
         return r.json()["data"]
     except Exception as e:
@@ -23,7 +31,7 @@ def fetch_metric_names():
 def query_instant(metric):
     """Fetch current value of metric (simpler, faster than range)"""
     try:
-        r = requests.get(f"{PROM}/api/v1/query", params={"query": metric}, timeout=10)
+        r = session.get(f"{PROM}/api/v1/query", params={"query": metric}, timeout=10)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -40,7 +48,7 @@ def push_bulk_to_es(docs):
         bulk_data += json.dumps(doc) + "\n"
 
     try:
-        r = requests.post(f"{ES}/_bulk", data=bulk_data, headers={"Content-Type": "application/x-ndjson"}, timeout=15)
+        r = session.post(f"{ES}/_bulk", data=bulk_data, headers={"Content-Type": "application/x-ndjson"}, timeout=15)
         if r.status_code not in (200, 201):
             print("⚠️ Elasticsearch bulk insert failed:", r.status_code, r.text[:300])
     except Exception as e:
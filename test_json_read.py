@@ -1,4 +1,4 @@
-with open("mock_metrics.json", "r", encoding="utf-8") as f:
+with open("mock_metrics.ndjson", "r", encoding="utf-8") as f:
     content = f.read()
 
 print("File length:", len(content))